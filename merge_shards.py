@@ -0,0 +1,30 @@
+"""
+merge_shards.py
+Copyright (c) 2022 Sony Group Corporation
+This software is released under the MIT License.
+http://opensource.org/licenses/mit-license.php
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+from myutils.datautils import merge_shard_results
+
+
+if __name__ == "__main__":
+    params = json.load(open("parameters.json", "r"))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_shards", type=int, default=params.get("num_shards", 1))
+    args = parser.parse_args()
+
+    input_path = Path("images").joinpath(params["input_folder"])
+    result_path = Path("results").joinpath(input_path.name)
+
+    with open(input_path.joinpath("macbeth_position.txt"), "r") as f:
+        lines = f.readlines()
+
+    merge_shard_results(result_path, "error.txt", lines, args.num_shards)
+    if params.get("low_memory", False):
+        merge_shard_results(result_path, "memory.txt", lines, args.num_shards)
@@ -5,8 +5,22 @@ This software is released under the MIT License.
 http://opensource.org/licenses/mit-license.php
 """
 
+import contextlib
+import hashlib
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows.
+    fcntl = None
+
 import numpy as np
 
+from .imageutils import my_read_image_rows
+
+GT_ILLUM_CACHE_NAME = "macbeth_illum_cache.json"
+
 
 def macbeth_position_txt_parse(line):
     scene_name = line.split(" ")[0]
@@ -26,6 +40,105 @@ def compute_gt_illum(macbeth, x, y, w, h):
     return np.array([r_val, g_val, b_val])
 
 
+def _read_gt_illum_cache(cache_path):
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+@contextlib.contextmanager
+def _gt_illum_cache_lock(cache_path):
+    # Serializes the read-merge-replace of the cache among processes where fcntl is available.
+    if fcntl is None:
+        yield
+        return
+
+    with open(str(cache_path) + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _gt_illum_cache_key(input_path, line):
+    scene_name, x, y, w, h = macbeth_position_txt_parse(line)
+    stat = input_path.joinpath("{}_macbeth.png".format(scene_name)).stat()
+    return scene_name, {"position": [x, y, w, h], "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _gt_illum_cache_entry_is_valid(entry, key):
+    return entry is not None and all(entry.get(k) == v for k, v in key.items())
+
+
+def load_gt_illums(input_path, lines):
+    """
+    Return the ground-truth illuminations of the scenes, computed once per dataset.
+    The illuminations are cached in GT_ILLUM_CACHE_NAME next to macbeth_position.txt.
+    A scene is recomputed when its chart position or its _macbeth.png (size or mtime) changes,
+    and only the chart region of _macbeth.png is converted in that case.
+    Scenes no longer listed in macbeth_position.txt are removed from the cache.
+    Args:
+        input_path: pathlib.Path
+            The folder containing macbeth_position.txt and the images.
+        lines: list
+            Lines of macbeth_position.txt whose illuminations you want.
+    Returns: dict
+        scene name ---> ndarray, identical to compute_gt_illum().
+    """
+    cache_path = input_path.joinpath(GT_ILLUM_CACHE_NAME)
+    cache = _read_gt_illum_cache(cache_path)
+
+    with open(input_path.joinpath("macbeth_position.txt"), "r") as f:
+        all_lines = [line for line in f.readlines() if line.strip()]
+    all_scene_names = set(macbeth_position_txt_parse(line)[0] for line in all_lines)
+
+    gt_illums, computed = {}, {}
+    for line in lines:
+        scene_name, key = _gt_illum_cache_key(input_path, line)
+
+        entry = cache.get(scene_name)
+        if not _gt_illum_cache_entry_is_valid(entry, key):
+            x, y, w, h = key["position"]
+            macbeth_path = input_path.joinpath("{}_macbeth.png".format(scene_name))
+            # Full-width rows keep the strides of the full image, so np.mean() adds the chart
+            # values in the same order and the illumination is identical to the full decode.
+            macbeth_rows = my_read_image_rows(macbeth_path, y, h)
+            entry = dict(key, illum=[float(v) for v in compute_gt_illum(macbeth_rows, x, 0, w, h)])
+            computed[scene_name] = entry
+
+        gt_illums[scene_name] = np.array(entry["illum"], dtype=np.float32)
+
+    if len(computed) > 0 or any(scene_name not in all_scene_names for scene_name in cache):
+        # Shards may update the cache concurrently, so the cache on disk is re-read under a lock
+        # right before it is replaced, and its entries computed by other shards are kept if they are still valid.
+        try:
+            with _gt_illum_cache_lock(cache_path):
+                cache = _read_gt_illum_cache(cache_path)
+                merged = {}
+                for line in all_lines:
+                    try:
+                        scene_name, key = _gt_illum_cache_key(input_path, line)
+                    except OSError:
+                        continue
+                    if scene_name in computed:
+                        merged[scene_name] = computed[scene_name]
+                    elif _gt_illum_cache_entry_is_valid(cache.get(scene_name), key):
+                        merged[scene_name] = cache[scene_name]
+
+                # Written atomically, so readers never see a partially written cache.
+                tmp_path = cache_path.with_name("{}.{}.tmp".format(cache_path.name, os.getpid()))
+                with open(tmp_path, "w") as f:
+                    json.dump(merged, f, indent=4)
+                os.replace(str(tmp_path), str(cache_path))
+        except OSError:
+            print("{} could not be written. GT illuminations are not cached.".format(cache_path))
+
+    return gt_illums
+
+
 def calc_ang_error(a, b):
     dot_ab = np.sum(a * b) / np.sqrt(np.sum(a * a)) / np.sqrt(np.sum(b * b))
 
@@ -59,20 +172,237 @@ def scene_err_list(path, sky_names):
 
 
 def scene_name_list_check(arg1, *args):
-    scene_name_list_is_same = True
+    scene_names = np.asarray(arg1)
 
-    scene_num = len(arg1)
     for arg in args:
-        if scene_num != len(arg):
+        if len(arg1) != len(arg) or not np.array_equal(scene_names, np.asarray(arg)):
             return False
-        else:
-            for i in range(scene_num):
-                if arg1[i] != arg[i]:
-                    return False
-                else:
-                    pass
 
-    return scene_name_list_is_same
+    return True
+
+
+def scene_err_matrix(paths, sky_names=()):
+    """
+    Load error.txt of many runs into a (runs x scenes) error matrix.
+    Args:
+        paths: list
+            Result folders (pathlib.Path) containing error.txt.
+        sky_names: list
+            Scenes to be flagged in the returned mask.
+    Returns: list, ndarray, ndarray
+        Scene names, the (runs x scenes) error matrix, and a boolean mask of the scenes not in sky_names.
+    --------
+    Raises:
+        ValueError: When no path is given or the runs don't share the same scene list.
+    """
+    if len(paths) == 0:
+        raise ValueError("Your input doesn't include any runs.")
+
+    scene_names_list, errs_list = [], []
+    for path in paths:
+        # Subsets are applied through noSky_mask, not by filtering the lists.
+        scene_names, errs, _ = scene_err_list(path, ())
+        scene_names_list.append(scene_names)
+        errs_list.append(errs)
+
+    if not scene_name_list_check(*scene_names_list):
+        raise ValueError("Your runs don't share the same scene list.")
+
+    scene_names = scene_names_list[0]
+    noSky_mask = ~np.isin(scene_names, list(sky_names))
+
+    return scene_names, np.array(errs_list), noSky_mask
+
+
+METRIC_NAMES = ("mean", "median", "trimean", "best25", "worst25")
+
+
+def _nan_if_any(err_array_sort, values):
+    # NaNs are sorted to the end, and np.median()/np.percentile() return NaN for such slices.
+    return np.where(np.isnan(err_array_sort[..., -1]), np.nan, values)
+
+
+def _sorted_median(err_array_sort):
+    scene_num = err_array_sort.shape[-1]
+    index = scene_num // 2
+    if scene_num % 2 == 1:
+        median = err_array_sort[..., index]
+    else:
+        median = (err_array_sort[..., index - 1] + err_array_sort[..., index]) / 2
+    return _nan_if_any(err_array_sort, median)
+
+
+def _sorted_percentile(err_array_sort, q):
+    # Same linear interpolation as np.percentile(), read from the already sorted array.
+    scene_num = err_array_sort.shape[-1]
+    virtual_index = (scene_num - 1) * (q / 100)
+    previous_index = int(np.floor(virtual_index))
+    next_index = min(previous_index + 1, scene_num - 1)
+    gamma = virtual_index - previous_index
+
+    previous = err_array_sort[..., previous_index]
+    diff = err_array_sort[..., next_index] - previous
+    if gamma >= 0.5:
+        percentile = err_array_sort[..., next_index] - diff * (1 - gamma)
+    else:
+        percentile = previous + diff * gamma
+    return _nan_if_any(err_array_sort, percentile)
+
+
+def _metrics_along_last_axis(err_array, overwrite_input=False):
+    mean = np.mean(err_array, axis=-1)
+
+    if overwrite_input:
+        err_array.sort(axis=-1)
+        err_array_sort = err_array
+    else:
+        err_array_sort = np.sort(err_array, axis=-1)
+
+    median = _sorted_median(err_array_sort)
+
+    # Compute trimean
+    q1 = _sorted_percentile(err_array_sort, 25)
+    q3 = _sorted_percentile(err_array_sort, 75)
+    tri_mean = (q1 + 2 * median + q3) / 4
+
+    # Compute good 25% and Bad 25%.
+    scene_num = err_array_sort.shape[-1]
+    scene_num_q = int(scene_num * 0.25)
+
+    mean_goodq = np.mean(err_array_sort[..., :scene_num_q], axis=-1)
+    mean_badq = np.mean(err_array_sort[..., scene_num-scene_num_q:], axis=-1)
+
+    return dict(zip(METRIC_NAMES, (mean, median, tri_mean, mean_goodq, mean_badq)))
+
+
+def _masked_err_matrix(err_matrix, mask):
+    err_matrix = np.asarray(err_matrix)
+    if err_matrix.ndim != 2:
+        raise ValueError("err_matrix must be (runs x scenes).")
+
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (err_matrix.shape[1],):
+            raise ValueError("mask must have one element per scene.")
+        err_matrix = err_matrix[:, mask]
+
+    if err_matrix.shape[1] == 0:
+        raise ValueError("Your err_matrix and mask don't include any scenes.")
+    return err_matrix
+
+
+def calc_various_metrics_batch(err_matrix, mask=None):
+    """
+    Return mean, median, trimean, mean of good/bad 25% of every run in one pass.
+    Args:
+        err_matrix: ndarray
+            (runs x scenes) errors.
+        mask: ndarray
+            Boolean array with one element per scene. Only scenes with True are used,
+            e.g. the noSky_mask of scene_err_matrix(). Use all scenes when None.
+    Returns: dict
+        METRIC_NAMES ---> ndarray of shape (runs,).
+    --------
+    Raises:
+        ValueError: When err_matrix isn't 2-D, or no scene is left after masking.
+    """
+    return _metrics_along_last_axis(_masked_err_matrix(err_matrix, mask))
+
+
+def _bootstrap_metric_samples(err_matrix, num_samples, seed, max_elements):
+    if num_samples < 1:
+        raise ValueError("num_samples must be larger than 0.")
+
+    run_num, scene_num = err_matrix.shape
+    rng = np.random.default_rng(seed)
+
+    # The gathered resamples are (runs x chunk x scenes), so the chunk is sized by max_elements.
+    chunk_size = max(1, max_elements // (run_num * scene_num))
+
+    samples = {name: np.empty((run_num, num_samples)) for name in METRIC_NAMES}
+    for start in range(0, num_samples, chunk_size):
+        sample_num = min(chunk_size, num_samples - start)
+
+        # The same resampled scenes are shared by all runs, so comparisons between runs are paired.
+        indices = rng.integers(0, scene_num, size=(sample_num, scene_num))
+        metrics = _metrics_along_last_axis(err_matrix[:, indices], overwrite_input=True)
+        for name in METRIC_NAMES:
+            samples[name][:, start: start + sample_num] = metrics[name]
+
+    return samples
+
+
+def bootstrap_metrics_ci(err_matrix, mask=None, num_samples=1000, ci=95., seed=0, max_elements=2 ** 25):
+    """
+    Return bootstrap confidence intervals of calc_various_metrics_batch() for every run.
+    Args:
+        err_matrix: ndarray
+            (runs x scenes) errors.
+        mask: ndarray
+            See the description of calc_various_metrics_batch().
+        num_samples: int
+            The number of bootstrap resamples of the scenes.
+        ci: float
+            Confidence level in percent.
+        seed: int
+        max_elements: int
+            The maximum number of errors gathered at once (runs x resamples x scenes).
+            The default is 256 MB for float64 errors. At least one resample is evaluated at once.
+    Returns: dict, dict
+        METRIC_NAMES ---> lower bounds of shape (runs,), and METRIC_NAMES ---> upper bounds.
+    --------
+    Raises:
+        ValueError: When no scene is left after masking, or num_samples is smaller than 1.
+    """
+    err_matrix = _masked_err_matrix(err_matrix, mask)
+    samples = _bootstrap_metric_samples(err_matrix, num_samples, seed, max_elements)
+
+    lower, upper = {}, {}
+    for name in METRIC_NAMES:
+        lower[name], upper[name] = np.percentile(samples[name], q=[(100 - ci) / 2, (100 + ci) / 2], axis=1)
+
+    return lower, upper
+
+
+def paired_bootstrap_comparison(err_matrix, reference=0, mask=None, num_samples=1000, ci=95., seed=0,
+                                max_elements=2 ** 25):
+    """
+    Compare every run against a reference run on the same bootstrap resamples.
+    Args:
+        err_matrix: ndarray
+            (runs x scenes) errors.
+        reference: int
+            Row index of the reference run.
+        mask, num_samples, ci, seed, max_elements:
+            See the description of bootstrap_metrics_ci().
+    Returns: dict
+        METRIC_NAMES ---> dict of ndarrays of shape (runs,):
+            "diff": metric(run) - metric(reference) on all the scenes.
+            "lower", "upper": confidence interval of the difference.
+            "p_worse": fraction of resamples where the run is not better (diff >= 0) than the reference.
+                       This is a bootstrap frequency, not a p-value. NaN for the reference itself.
+    --------
+    Raises:
+        ValueError: When no scene is left after masking, or num_samples is smaller than 1.
+    """
+    err_matrix = _masked_err_matrix(err_matrix, mask)
+    metrics = _metrics_along_last_axis(err_matrix)
+    samples = _bootstrap_metric_samples(err_matrix, num_samples, seed, max_elements)
+
+    comparison = {}
+    for name in METRIC_NAMES:
+        diffs = samples[name] - samples[name][reference]
+        lower, upper = np.percentile(diffs, q=[(100 - ci) / 2, (100 + ci) / 2], axis=1)
+        p_worse = np.mean(diffs >= 0, axis=1)
+        p_worse[reference] = np.nan
+        comparison[name] = {
+            "diff": metrics[name] - metrics[name][reference],
+            "lower": lower,
+            "upper": upper,
+            "p_worse": p_worse,
+        }
+
+    return comparison
 
 
 def calc_various_metrics(err_array, method_name):
@@ -84,21 +414,93 @@ def calc_various_metrics(err_array, method_name):
         method_name: str
     Returns: float
     """
-    mean = np.mean(err_array)
-    median = np.median(err_array)
+    metrics = calc_various_metrics_batch(np.asarray(err_array)[np.newaxis])
 
-    err_array_sort = np.sort(err_array)
+    print("{:<15} & {:.2f} & {:.2f} & {:.2f} & {:.2f} & {:.2f}".format(
+        method_name, *[metrics[name][0] for name in METRIC_NAMES]))
 
-    # Compute trimean
-    q1, q3 = np.percentile(err_array_sort, q=[25, 75])
-    tri_mean = (q1 + 2 * median + q3) / 4
 
-    # Compute good 25% and Bad 25%.
-    scene_num = err_array_sort.shape[0]
-    scene_num_q = int(scene_num * 0.25)
+def shard_scene_lines(lines, num_shards, shard_index, method="index"):
+    """
+    Return the lines of macbeth_position.txt assigned to one shard.
+    Every scene belongs to exactly one shard, and the assignment is the same on every machine.
+    Args:
+        lines: list
+            Lines of macbeth_position.txt.
+        num_shards: int
+        shard_index: int
+            Must be between 0 and num_shards - 1.
+        method: str
+            "index": the i-th scene goes to shard i % num_shards.
+            "hash": the scene goes to shard md5(scene_name) % num_shards,
+                    which is stable when scenes are added to or removed from the list.
+    Returns: list
+    """
+    if num_shards < 1:
+        raise ValueError("num_shards must be larger than 0.")
+    if shard_index < 0 or shard_index >= num_shards:
+        raise ValueError("shard_index must be between 0 and {}. Your input is {}".format(num_shards - 1, shard_index))
 
-    mean_goodq = np.mean(err_array_sort[:scene_num_q])
-    mean_badq = np.mean(err_array_sort[scene_num-scene_num_q:])
+    lines = [line for line in lines if line.strip()]
 
-    print("{:<15} & {:.2f} & {:.2f} & {:.2f} & {:.2f} & {:.2f}".format(
-        method_name, mean, median, tri_mean, mean_goodq, mean_badq))
+    if method == "index":
+        return [line for i, line in enumerate(lines) if i % num_shards == shard_index]
+    elif method == "hash":
+        # Python's hash() is salted per process, so md5 is used instead.
+        return [line for line in lines
+                if int(hashlib.md5(line.split(" ")[0].encode()).hexdigest(), 16) % num_shards == shard_index]
+    else:
+        raise ValueError("method must be 'index' or 'hash'. Your input is {}".format(method))
+
+
+def shard_file_name(file_name, num_shards, shard_index):
+    """
+    Return the per-shard name of a result file, e.g. error.txt -> error_shard001of004.txt.
+    A single-shard run keeps the original name.
+    """
+    if num_shards == 1:
+        return file_name
+
+    stem, ext = file_name.rsplit(".", 1)
+    return "{}_shard{:03d}of{:03d}.{}".format(stem, shard_index, num_shards, ext)
+
+
+def merge_shard_results(path, file_name, lines, num_shards):
+    """
+    Merge per-shard result files into one file ordered as macbeth_position.txt.
+    The merged file is identical to the one written by a single-node run.
+    Args:
+        path: pathlib.Path
+            Result folder containing the per-shard files.
+        file_name: str
+            e.g. "error.txt".
+        lines: list
+            Lines of macbeth_position.txt.
+        num_shards: int
+    --------
+    Raises:
+        FileNotFoundError: When a shard's result file is missing.
+        ValueError: When a scene is missing, duplicated, or unexpected among the shards.
+    """
+    scene_names = [macbeth_position_txt_parse(line)[0] for line in lines if line.strip()]
+
+    results = {}
+    for shard_index in range(num_shards):
+        with open(path.joinpath(shard_file_name(file_name, num_shards, shard_index)), "r") as f:
+            for result_line in f.readlines():
+                scene_name = result_line.split("'")[0]
+                if scene_name in results:
+                    raise ValueError("{} appears in more than one shard.".format(scene_name))
+                results[scene_name] = result_line
+
+    missing = [scene_name for scene_name in scene_names if scene_name not in results]
+    if len(missing) > 0:
+        raise ValueError("Results of {} are missing.".format(", ".join(missing)))
+
+    unexpected = [scene_name for scene_name in results if scene_name not in scene_names]
+    if len(unexpected) > 0:
+        raise ValueError("Results of {} are not listed in macbeth_position.txt.".format(", ".join(unexpected)))
+
+    with open(path.joinpath(file_name), "w") as f:
+        for scene_name in scene_names:
+            f.write(results[scene_name])
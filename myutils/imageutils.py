@@ -12,6 +12,30 @@ MAX_8BIT = 255.
 MAX_16BIT = 65535.
 
 
+def _imread_checked(img_path):
+    """
+    Return an image loaded by cv2.imread() as it is, i.e., in BGR(A) order and its original type.
+    -------
+    Raises:
+        TypeError: When your input path is not the pathlib.Path object.
+        FileNotFoundError: When your input path does not include any images.
+    """
+    if not isinstance(img_path, pathlib.Path):
+        raise TypeError("Input type must be pathlib.Path object.")
+    else:
+        img = cv2.imread(str(img_path), -1)
+        if img is None:
+            raise FileNotFoundError("{} not found.".format(str(img_path)))
+        else:
+            return img
+
+
+def _bgr_to_rgb_float32(img):
+    # Swap BGR(A) to RGB through a view so that only the float32 copy is allocated.
+    # Alpha is dropped as cv2.cvtColor() did.
+    return img[..., 2::-1].astype(np.float32, order="C")
+
+
 def my_read_image(img_path):
     """
     Return a loaded image according to the input path.
@@ -27,17 +51,31 @@ def my_read_image(img_path):
         TypeError: When your input path is not the pathlib.Path object.
         FileNotFoundError: When your input path does not include any images.
     """
-    if not isinstance(img_path, pathlib.Path):
-        raise TypeError("Input type must be pathlib.Path object.")
-    else:
-        img = cv2.imread(str(img_path), -1)
-        if img is None:
-            raise FileNotFoundError("{} not found.".format(str(img_path)))
-        else:
-            img = img.astype(np.float32)
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return _bgr_to_rgb_float32(_imread_checked(img_path))
 
-            return img
+
+def my_read_image_rows(img_path, y, h):
+    """
+    Return the rows [y, y + h) of an image according to the input path.
+    Only these rows are converted to float32 and sorted as RGB order,
+    so the result is identical to my_read_image(img_path)[y: y + h].
+    The rows keep the full width, so that reductions over a crop of them add the values
+    in the same order as over the same crop of the full image.
+    Note that PNG doesn't support random access, so the whole file is still decompressed.
+
+    Args:
+        img_path: pathlib.Path
+            File path of an image you want to load.
+        y, h: int
+            The first row and the number of rows you want to load.
+    Returns: ndarray
+        Loaded rows sorted as RGB order. Astype is numpy.float32.
+    -------
+    Raises:
+        TypeError: When your input path is not the pathlib.Path object.
+        FileNotFoundError: When your input path does not include any images.
+    """
+    return _bgr_to_rgb_float32(_imread_checked(img_path)[y: y + h])
 
 
 def my_write_image(img_path, img):
@@ -61,8 +99,7 @@ def my_write_image(img_path, img):
         if np.min(img) < 0 or np.max(img) > MAX_16BIT:
             raise ValueError("Your input array's range doesn't match to 16bit.")
         else:
-            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-            cv2.imwrite(str(img_path), img.astype(np.uint16))
+            cv2.imwrite(str(img_path), img[..., ::-1].astype(np.uint16, order="C"))
 
 
 def rgb_to_srgb(img):
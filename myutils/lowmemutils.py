@@ -0,0 +1,146 @@
+"""
+lowmemutils.py
+Copyright (c) 2022 Sony Group Corporation
+This software is released under the MIT License.
+http://opensource.org/licenses/mit-license.php
+"""
+import sys
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+import numpy as np
+
+from .imageutils import MAX_16BIT, my_read_image
+from . import polarutils as plutil
+from . import weighturils as weutil
+from . import wbutils as wbutil
+
+# Maximum number of live full-frame (H, W, 3) float32 buffers in polarAWB_lowmem().
+# The peak is reached while the Stokes parameters are computed: i000, i045, i090, i135, and s0.
+# imean is loaded only after the Stokes parameters are released.
+# (H, W) float32 weight planes count as 1/3 of a buffer each and never exceed 2 buffers in total.
+MAX_LIVE_FULLFRAME_BUFFERS = 5
+
+
+def read_normalized_image(img_path):
+    """
+    Return a loaded image normalized into (0, 1) as float32, normalized in place.
+    Args:
+        img_path: pathlib.Path
+            See the description of my_read_image().
+    Returns: ndarray
+    """
+    img = my_read_image(img_path)
+    img /= MAX_16BIT
+    return img
+
+
+def polarAWB_lowmem(imean_path, i000_path, i045_path, i090_path, i135_path, params):
+    """
+    Return the estimated illumination with at most MAX_LIVE_FULLFRAME_BUFFERS full-frame buffers alive.
+    Each stage is computed in place in float32, and each buffer is released as soon as it is consumed.
+    The polarization images are loaded here so that their buffers are owned and released by this function.
+    Args:
+        imean_path, i000_path, i045_path, i090_path, i135_path: pathlib.Path
+            File paths of the mean and four-directional polarization images.
+        params: dict
+            Parameters loaded from parameters.json.
+    Returns: ndarray, ndarray
+        The estimated illumination and the normalized imean.
+    """
+    i000 = read_normalized_image(i000_path)
+    i045 = read_normalized_image(i045_path)
+    i090 = read_normalized_image(i090_path)
+    i135 = read_normalized_image(i135_path)
+
+    w_valid = weutil.valid_weight_fourPolar_lowmem(i000, i045, i090, i135, th=params["valid_th"])
+
+    s0, s1, s2 = plutil.calc_s0s1s2_from_fourPolar_lowmem(i000, i045, i090, i135)
+    del i000, i045, i090, i135
+
+    dolp, aolp = plutil.calc_dolp_aolp_from_s0s1s2_lowmem(s0, s1, s2)
+    del s0, s1, s2
+
+    imean = read_normalized_image(imean_path)
+
+    # Weights. The shared factor w_valid * w_dolp is folded into w_valid.
+    w_dolp = weutil.sigmoid_lowmem(
+        np.mean(dolp, axis=2), alpha=params["w_dolp_a"], center=params["w_dolp_b"])
+    w_valid *= w_dolp
+    del w_dolp
+
+    weight_achromatic = weutil.rg_bg_sigmoid_weight_achromatic_lowmem(
+        dolp, alpha=params["w_dolp_ach_a"], center=params["w_dolp_ach_b"], normalize=True)
+    np.multiply(w_valid, weight_achromatic, out=weight_achromatic)
+    weight_achromatic *= weutil.rg_bg_sigmoid_weight_achromatic_phase_lowmem(
+        aolp, alpha=params["w_aolp_ach_a"], center=params["w_aolp_ach_b"])
+
+    weight_chromatic = weutil.rg_bg_sigmoid_weight_chromatic_lowmem(
+        dolp, alpha=params["w_dolp_ch_a"], center=params["w_dolp_ch_b"], normalize=True)
+    np.multiply(w_valid, weight_chromatic, out=weight_chromatic)
+    weight_chromatic *= weutil.rg_bg_sigmoid_weight_achromatic_phase_lowmem(
+        aolp, alpha=params["w_aolp_ch_a"], center=params["w_aolp_ch_b"])
+    del w_valid, aolp
+
+    # WB.
+    illum_est = wbutil.polarAWB(
+        dolp, imean, weight_achromatic, weight_chromatic, params["alpha"], low_memory=True)
+
+    return illum_est, imean
+
+
+class PeakMemoryTracker:
+    """
+    Measure the peak traced allocation between start() and stop().
+    numpy and OpenCV arrays are traced through tracemalloc, but the interpreter, libraries, and
+    allocator overhead are not, so this is not the memory a process needs.
+    The peak RSS of the whole process so far (ru_maxrss), which is what a container memory limit
+    applies to, is recorded as well where the resource module is available.
+    Can also be used as a context manager.
+    """
+    def __init__(self):
+        self.peak_bytes = 0
+        self.peak_rss_bytes = None
+        self._started_here = False
+
+    def start(self):
+        self._started_here = not tracemalloc.is_tracing()
+        if self._started_here:
+            tracemalloc.start()
+        else:
+            tracemalloc.clear_traces()
+
+    def stop(self):
+        self.peak_bytes = tracemalloc.get_traced_memory()[1]
+        if self._started_here:
+            tracemalloc.stop()
+
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+            scale = 1 if sys.platform == "darwin" else 1024
+            self.peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    @property
+    def peak_mb(self):
+        return self.peak_bytes / 2 ** 20
+
+    def report(self, scene_name):
+        """
+        Return a line for memory.txt.
+        """
+        line = "{}'s Peak traced allocation: {:.1f} MB".format(scene_name, self.peak_mb)
+        if self.peak_rss_bytes is not None:
+            line += ", Process peak RSS: {:.1f} MB".format(self.peak_rss_bytes / 2 ** 20)
+        return line + "\n"
@@ -60,3 +60,66 @@ def calc_aolp_from_s1s2(s1, s2):
     phase = np.clip(phase, 0, AOLPMAX_DEG)
 
     return phase
+
+
+def calc_s0s1s2_from_fourPolar_lowmem(i000, i045, i090, i135):
+    """
+    Return s0, s1, and s2 from four-directional polarization images, reusing the input buffers.
+    The results are identical to calc_s0s1s2_from_fourPolar().
+    s0 is the only newly allocated buffer; s1 and s2 are written into i090 and i135,
+    so i000 and i045 can be released by the caller afterwards.
+    Args:
+        i000: ndarray
+        i045: ndarray
+        i090: ndarray
+            Overwritten by s1.
+        i135: ndarray
+            Overwritten by s2.
+    Returns: ndarray
+    """
+    s0 = np.add(i000, i045)
+    s0 += i090
+    s0 += i135
+    s0 /= 2.
+    s1 = np.subtract(i000, i090, out=i090)
+    s2 = np.subtract(i045, i135, out=i135)
+
+    return s0, s1, s2
+
+
+def calc_dolp_aolp_from_s0s1s2_lowmem(s0, s1, s2):
+    """
+    Return DoLP and AoLP from s0, s1, and s2, reusing the input buffers.
+    The results are identical to calc_dolp_from_s0s1s2() and calc_aolp_from_s1s2().
+    AoLP is the only newly allocated buffer; DoLP is written into s1, and s0 and s2 are destroyed.
+    Args:
+        s0: ndarray
+            Destroyed.
+        s1: ndarray
+            Overwritten by DoLP.
+        s2: ndarray
+            Destroyed.
+    Returns: ndarray
+        DoLP and AoLP (degree), [0, 180).
+    """
+    # AoLP first, since DoLP overwrites s1 and s2.
+    zero_mask = (s1 == 0)
+    s1[zero_mask] = 1e-06
+    phase = np.arctan2(s2, s1)
+    s1[zero_mask] = 0
+    del zero_mask
+
+    np.rad2deg(phase, out=phase)
+    np.add(phase, AOLPMAX_DEG * 2, out=phase, where=(phase < 0))
+    phase /= 2.
+    np.clip(phase, 0, AOLPMAX_DEG, out=phase)
+
+    np.clip(s0, 1e-06, None, out=s0)
+    dolp = np.multiply(s1, s1, out=s1)
+    np.multiply(s2, s2, out=s2)
+    dolp += s2
+    np.sqrt(dolp, out=dolp)
+    dolp /= s0
+    np.clip(dolp, 0, 1, out=dolp)
+
+    return dolp, phase
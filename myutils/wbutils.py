@@ -9,14 +9,20 @@ import numpy as np
 
 
 def polarAWB_achromatic(imean, weight):
-    pixels_r = np.copy(imean[..., 0])
-    pixels_g = np.copy(imean[..., 1])
-    pixels_b = np.copy(imean[..., 2])
+    pixels_r = imean[..., 0]
+    pixels_b = imean[..., 2]
 
-    pixels_g = np.clip(pixels_g, 1e-06, None)
+    pixels_g = np.clip(imean[..., 1], 1e-06, None)
+    weight_sum = np.sum(weight)
 
-    illum_r = np.sum(pixels_r * weight / pixels_g) / np.sum(weight)
-    illum_b = np.sum(pixels_b * weight / pixels_g) / np.sum(weight)
+    # A single scratch plane is shared by both channels.
+    weighted = np.multiply(pixels_r, weight)
+    weighted /= pixels_g
+    illum_r = np.sum(weighted) / weight_sum
+
+    np.multiply(pixels_b, weight, out=weighted)
+    weighted /= pixels_g
+    illum_b = np.sum(weighted) / weight_sum
     return np.array([illum_r, 1, illum_b])
 
 
@@ -42,7 +48,45 @@ def polarAWB_chromatic(dolp, imean, weight):
     return np.array([1 / r_gain, 1, 1 / b_gain])
 
 
-def polarAWB(dolp, imean, weight_ach, weight_ch, achromatic_ratio_default):
+def polarAWB_chromatic_lowmem(dolp, imean, weight):
+    """
+    Return polarAWB_chromatic() without gathering the valid pixels into compact copies.
+    Pixels with zero weight contribute zero rows to the least-squares system, so the system is
+    accumulated over full (H, W) planes and solved through its 2x2 normal equations.
+    The result agrees with polarAWB_chromatic() up to floating-point rounding.
+    """
+    weight_sum = np.sum(weight)
+
+    dop_R, dop_G, dop_B = dolp[..., 0], dolp[..., 1], dolp[..., 2]
+
+    def _row(dop_p, dop_m, pixels):
+        row = np.subtract(dop_p, dop_m)
+        row *= pixels
+        row *= weight
+        row /= weight_sum
+        return row
+
+    a_r = _row(dop_G, dop_B, imean[..., 0])
+    a_b = _row(dop_R, dop_G, imean[..., 2])
+    ys = _row(dop_R, dop_B, imean[..., 1])
+
+    # Dot products are accumulated in float64 through a single float32 scratch plane.
+    scratch = np.empty_like(a_r)
+
+    def _dot(a, b):
+        np.multiply(a, b, out=scratch)
+        return np.sum(scratch, dtype=np.float64)
+
+    AtA = np.array([[_dot(a_r, a_r), _dot(a_r, a_b)],
+                    [_dot(a_r, a_b), _dot(a_b, a_b)]])
+    Aty = np.array([_dot(a_r, ys), _dot(a_b, ys)])
+
+    r_gain, b_gain = np.linalg.pinv(AtA).dot(Aty)
+
+    return np.array([1 / r_gain, 1, 1 / b_gain])
+
+
+def polarAWB(dolp, imean, weight_ach, weight_ch, achromatic_ratio_default, low_memory=False):
     if np.sum(weight_ach) > 0:
         illum_achromatic = polarAWB_achromatic(imean, weight_ach)
         achromatic_ratio = achromatic_ratio_default
@@ -51,7 +95,10 @@ def polarAWB(dolp, imean, weight_ach, weight_ch, achromatic_ratio_default):
         achromatic_ratio = 0
 
     if np.sum(weight_ch) > 0:
-        illum_chromatic = polarAWB_chromatic(dolp, imean, weight_ch)
+        if low_memory:
+            illum_chromatic = polarAWB_chromatic_lowmem(dolp, imean, weight_ch)
+        else:
+            illum_chromatic = polarAWB_chromatic(dolp, imean, weight_ch)
         chromatic_ratio = 1 - achromatic_ratio
     else:
         illum_chromatic = np.array([1, 1, 1])
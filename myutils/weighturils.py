@@ -215,3 +215,151 @@ def rg_bg_sigmoid_weight_achromatic_phase(phase, alpha, center):
     weight_bg = np.clip(sigmoid(diff_bg, alpha=alpha, center=center), 0, 1)
 
     return (1 - weight_rg) * (1 - weight_bg)
+
+
+def sigmoid_lowmem(xs, alpha, center):
+    """
+    Overwrite an array with its sigmoid, element-wise.
+    The result is identical to sigmoid().
+    Args:
+        xs: ndarray
+            The values whose sigmoid is required. Overwritten by the result.
+        alpha: float
+            See the description of sigmoid().
+        center: float
+            See the description of sigmoid().
+    Returns: ndarray
+        xs.
+    """
+    if alpha <= 0:
+        raise ValueError("Alpha must be larger than 0.")
+
+    sigmoid_range = 34.538776394910684
+
+    xs -= center
+    xs *= -alpha
+    np.clip(xs, -sigmoid_range, sigmoid_range, out=xs)
+    np.exp(xs, out=xs)
+    xs += 1
+    return np.divide(1, xs, out=xs)
+
+
+def valid_weight_fourPolar_lowmem(i000, i045, i090, i135, th):
+    """
+    Return valid_weight_fourPolar() without allocating per-image float masks.
+    Only a single (H, W) float32 plane and one boolean plane at a time are allocated.
+    Args:
+        i000, i045, i090, i135: ndarray
+            See the description of valid_weight().
+        th: float
+            See the description of valid_weight().
+    Returns: ndarray
+    """
+    if th > 1 or th < 0:
+        raise ValueError("Threshold must be between 0 and 1. Your input is {}".format(th))
+
+    min_th = th
+    max_th = 1 - th
+
+    weight = np.ones(i000.shape[:2], dtype=np.float32)
+    for img in (i000, i045, i090, i135):
+        if img.ndim != 3 or img.shape[2] != 3:
+            raise TypeError("Your input image doesn't contain color channels.")
+        if np.max(img) > 1 or np.min(img) < 0:
+            raise ValueError("Input image must be normalized into (0, 1).")
+
+        for c in range(3):
+            weight *= (img[..., c] > min_th)
+            weight *= (img[..., c] < max_th)
+
+    return weight
+
+
+def _rg_bg_sigmoid_weight_lowmem(diff_rg, diff_bg, alpha, center, achromatic):
+    sigmoid_lowmem(diff_rg, alpha=alpha, center=center)
+    sigmoid_lowmem(diff_bg, alpha=alpha, center=center)
+    np.clip(diff_rg, 0, 1, out=diff_rg)
+    np.clip(diff_bg, 0, 1, out=diff_bg)
+
+    if achromatic:
+        np.subtract(1, diff_rg, out=diff_rg)
+        np.subtract(1, diff_bg, out=diff_bg)
+
+    diff_rg *= diff_bg
+    return diff_rg
+
+
+def calc_rg_bg_diff_lowmem(img, normalize):
+    """
+    Return calc_rg_bg_diff() allocating only the two returned (H, W) planes and one scratch plane.
+    """
+    if img.ndim != 3 or img.shape[2] != 3:
+        raise TypeError("Your input image doesn't contain color channels.")
+    if not isinstance(normalize, bool):
+        raise TypeError("normalize must be bool.")
+
+    r, g, b = img[..., 0], img[..., 1], img[..., 2]
+
+    diff_rg = np.subtract(r, g)
+    np.abs(diff_rg, out=diff_rg)
+    diff_bg = np.subtract(b, g)
+    np.abs(diff_bg, out=diff_bg)
+
+    if normalize:
+        rgb_mean = np.add(r, g)
+        rgb_mean += b
+        rgb_mean /= 3.
+        np.clip(rgb_mean, 1e-06, None, out=rgb_mean)
+
+        diff_rg /= rgb_mean
+        diff_bg /= rgb_mean
+
+    return diff_rg, diff_bg
+
+
+def calc_rg_bg_diff_phase_lowmem(phase):
+    """
+    Return calc_rg_bg_diff_phase() allocating only the two returned (H, W) planes and one boolean plane.
+    """
+    if phase.ndim != 3 or phase.shape[2] != 3:
+        raise TypeError("Your input phase doesn't contain color channels.")
+    if np.min(phase) < 0 or np.max(phase) > AOLPMAX_DEG:
+        raise ValueError("Your phase has wrong range.")
+
+    flip_deg = 90.
+
+    r, g, b = phase[..., 0], phase[..., 1], phase[..., 2]
+
+    diffs = []
+    for ch in (r, b):
+        diff = np.subtract(ch, g)
+        np.abs(diff, out=diff)
+        np.subtract(AOLPMAX_DEG, diff, out=diff, where=(diff > flip_deg))
+        np.clip(diff, 0, AOLPMAX_DEG, out=diff)
+        diffs.append(diff)
+
+    return diffs[0], diffs[1]
+
+
+def rg_bg_sigmoid_weight_achromatic_lowmem(img, alpha, center, normalize):
+    """
+    Return rg_bg_sigmoid_weight_achromatic() computed in place on the difference planes.
+    """
+    diff_rg, diff_bg = calc_rg_bg_diff_lowmem(img, normalize=normalize)
+    return _rg_bg_sigmoid_weight_lowmem(diff_rg, diff_bg, alpha, center, achromatic=True)
+
+
+def rg_bg_sigmoid_weight_chromatic_lowmem(img, alpha, center, normalize):
+    """
+    Return rg_bg_sigmoid_weight_chromatic() computed in place on the difference planes.
+    """
+    diff_rg, diff_bg = calc_rg_bg_diff_lowmem(img, normalize=normalize)
+    return _rg_bg_sigmoid_weight_lowmem(diff_rg, diff_bg, alpha, center, achromatic=False)
+
+
+def rg_bg_sigmoid_weight_achromatic_phase_lowmem(phase, alpha, center):
+    """
+    Return rg_bg_sigmoid_weight_achromatic_phase() computed in place on the difference planes.
+    """
+    diff_rg, diff_bg = calc_rg_bg_diff_phase_lowmem(phase=phase)
+    return _rg_bg_sigmoid_weight_lowmem(diff_rg, diff_bg, alpha, center, achromatic=True)
@@ -5,6 +5,7 @@ This software is released under the MIT License.
 http://opensource.org/licenses/mit-license.php
 """
 
+import argparse
 import json
 from pathlib import Path
 import shutil
@@ -12,15 +13,26 @@ import shutil
 import numpy as np
 
 from myutils.imageutils import MAX_16BIT, my_read_image, my_write_image
-from myutils.datautils import macbeth_position_txt_parse, compute_gt_illum, calc_ang_error
+from myutils.datautils import macbeth_position_txt_parse, calc_ang_error, shard_scene_lines, shard_file_name, \
+    load_gt_illums
 import myutils.polarutils as plutil
 import myutils.weighturils as weutil
 import myutils.wbutils as wbutil
+from myutils.lowmemutils import polarAWB_lowmem, PeakMemoryTracker
 
 
 if __name__ == "__main__":
     params = json.load(open("parameters.json", "r"))
 
+    # Shard settings in parameters.json can be overridden per node.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_shards", type=int, default=params.get("num_shards", 1))
+    parser.add_argument("--shard_index", type=int, default=params.get("shard_index", 0))
+    parser.add_argument("--shard_method", default=params.get("shard_method", "index"))
+    args = parser.parse_args()
+
+    low_memory = params.get("low_memory", False)
+
     input_path = Path("images").joinpath(params["input_folder"])
 
     result_path = Path("results").joinpath(input_path.name)
@@ -29,66 +41,94 @@ if __name__ == "__main__":
 
     with open(input_path.joinpath("macbeth_position.txt"), "r") as f:
         lines = f.readlines()
+    lines = shard_scene_lines(lines, args.num_shards, args.shard_index, method=args.shard_method)
+
+    error_file_name = shard_file_name("error.txt", args.num_shards, args.shard_index)
+    memory_file_name = shard_file_name("memory.txt", args.num_shards, args.shard_index)
+    # Truncate this shard's result files, so that a re-run replaces its output
+    # and the files exist even when no scene is assigned to this shard.
+    if args.num_shards > 1:
+        open(result_path.joinpath(error_file_name), "w").close()
+    # Peak memory is reported only in the low-memory mode.
+    if low_memory:
+        open(result_path.joinpath(memory_file_name), "w").close()
+
+    gt_illums = load_gt_illums(input_path, lines)
 
     for line in lines:
-        scene_name, x, y, w, h = macbeth_position_txt_parse(line)
+        scene_name = macbeth_position_txt_parse(line)[0]
 
         imean_path = input_path.joinpath("{}_imean.png".format(scene_name))
         i000_path = input_path.joinpath("{}_i000.png".format(scene_name))
         i045_path = input_path.joinpath("{}_i045.png".format(scene_name))
         i090_path = input_path.joinpath("{}_i090.png".format(scene_name))
         i135_path = input_path.joinpath("{}_i135.png".format(scene_name))
-        macbeth_path = input_path.joinpath("{}_macbeth.png".format(scene_name))
-
-        imean = my_read_image(imean_path) / MAX_16BIT
-        i000 = my_read_image(i000_path) / MAX_16BIT
-        i045 = my_read_image(i045_path) / MAX_16BIT
-        i090 = my_read_image(i090_path) / MAX_16BIT
-        i135 = my_read_image(i135_path) / MAX_16BIT
-        macbeth = my_read_image(macbeth_path)
-
-        s0, s1, s2 = plutil.calc_s0s1s2_from_fourPolar(i000, i045, i090, i135)
-        dolp = plutil.calc_dolp_from_s0s1s2(s0, s1, s2)
-        aolp = plutil.calc_aolp_from_s1s2(s1, s2)
-
-        # Weights
-        w_valid = weutil.valid_weight_fourPolar(i000, i045, i090, i135, th=params["valid_th"])
-        w_dolp = weutil.sigmoid(
-            np.mean(dolp, axis=2), alpha=params["w_dolp_a"], center=params["w_dolp_b"])
-        w_dolp_ach = weutil.rg_bg_sigmoid_weight_achromatic(
-            dolp, alpha=params["w_dolp_ach_a"], center=params["w_dolp_ach_b"], normalize=True)
-        w_aolp_ach = weutil.rg_bg_sigmoid_weight_achromatic_phase(
-            aolp, alpha=params["w_aolp_ach_a"], center=params["w_aolp_ach_b"])
-
-        w_dolp_ch = weutil.rg_bg_sigmoid_weight_chromatic(
-            dolp, alpha=params["w_dolp_ch_a"], center=params["w_dolp_ch_b"], normalize=True)
-        w_aolp_ch = weutil.rg_bg_sigmoid_weight_achromatic_phase(
-            aolp, alpha=params["w_aolp_ch_a"], center=params["w_aolp_ch_b"])
-
-        weight_achromatic = w_valid * w_dolp * w_dolp_ach * w_aolp_ach
-        weight_chromatic = w_valid * w_dolp * w_dolp_ch * w_aolp_ch
-
-        # WB.
-        illum_est = wbutil.polarAWB(dolp, imean, weight_achromatic, weight_chromatic, params["alpha"])
+
+        if low_memory:
+            tracker = PeakMemoryTracker()
+            tracker.start()
+
+            illum_est, imean = polarAWB_lowmem(
+                imean_path, i000_path, i045_path, i090_path, i135_path, params)
+        else:
+            imean = my_read_image(imean_path) / MAX_16BIT
+            i000 = my_read_image(i000_path) / MAX_16BIT
+            i045 = my_read_image(i045_path) / MAX_16BIT
+            i090 = my_read_image(i090_path) / MAX_16BIT
+            i135 = my_read_image(i135_path) / MAX_16BIT
+
+            s0, s1, s2 = plutil.calc_s0s1s2_from_fourPolar(i000, i045, i090, i135)
+            dolp = plutil.calc_dolp_from_s0s1s2(s0, s1, s2)
+            aolp = plutil.calc_aolp_from_s1s2(s1, s2)
+
+            # Weights
+            w_valid = weutil.valid_weight_fourPolar(i000, i045, i090, i135, th=params["valid_th"])
+            w_dolp = weutil.sigmoid(
+                np.mean(dolp, axis=2), alpha=params["w_dolp_a"], center=params["w_dolp_b"])
+            w_dolp_ach = weutil.rg_bg_sigmoid_weight_achromatic(
+                dolp, alpha=params["w_dolp_ach_a"], center=params["w_dolp_ach_b"], normalize=True)
+            w_aolp_ach = weutil.rg_bg_sigmoid_weight_achromatic_phase(
+                aolp, alpha=params["w_aolp_ach_a"], center=params["w_aolp_ach_b"])
+
+            w_dolp_ch = weutil.rg_bg_sigmoid_weight_chromatic(
+                dolp, alpha=params["w_dolp_ch_a"], center=params["w_dolp_ch_b"], normalize=True)
+            w_aolp_ch = weutil.rg_bg_sigmoid_weight_achromatic_phase(
+                aolp, alpha=params["w_aolp_ch_a"], center=params["w_aolp_ch_b"])
+
+            weight_achromatic = w_valid * w_dolp * w_dolp_ach * w_aolp_ach
+            weight_chromatic = w_valid * w_dolp * w_dolp_ch * w_aolp_ch
+
+            # WB.
+            illum_est = wbutil.polarAWB(dolp, imean, weight_achromatic, weight_chromatic, params["alpha"])
 
         # Compute Error.
-        illum_gt = compute_gt_illum(macbeth, x, y, w, h)
+        illum_gt = gt_illums[scene_name]
         err_deg = calc_ang_error(illum_est, illum_gt)
-        with open(result_path.joinpath("error.txt"), "a") as f2:
+        with open(result_path.joinpath(error_file_name), "a") as f2:
             f2.write("{}'s Error: {:.3f}\n".format(scene_name, err_deg))
 
-        # Save White-balanced Images.
-        macbeth_wb = np.copy(imean)
+        # Save White-balanced Images. A single buffer is reused for both images.
         polar_wb = np.copy(imean)
 
         polar_wb[..., 0] /= illum_est[..., 0]
         polar_wb[..., 2] /= illum_est[..., 2]
-        polar_wb = np.clip(polar_wb, 0, 1) * MAX_16BIT
+        np.clip(polar_wb, 0, 1, out=polar_wb)
+        polar_wb *= MAX_16BIT
         my_write_image(result_path.joinpath("{}_PolarWB.png".format(scene_name)), polar_wb)
 
-        r_gain = illum_gt[1] / illum_gt[0]
-        b_gain = illum_gt[1] / illum_gt[2]
-        macbeth_wb[..., 0] *= r_gain
-        macbeth_wb[..., 2] *= b_gain
-        macbeth_wb = np.clip(macbeth_wb, 0, 1) * MAX_16BIT
-        my_write_image(result_path.joinpath("{}_MacbethWB.png".format(scene_name)), macbeth_wb)
+        if params.get("save_macbeth_wb", True):
+            macbeth_wb = polar_wb
+            np.copyto(macbeth_wb, imean)
+
+            r_gain = illum_gt[1] / illum_gt[0]
+            b_gain = illum_gt[1] / illum_gt[2]
+            macbeth_wb[..., 0] *= r_gain
+            macbeth_wb[..., 2] *= b_gain
+            np.clip(macbeth_wb, 0, 1, out=macbeth_wb)
+            macbeth_wb *= MAX_16BIT
+            my_write_image(result_path.joinpath("{}_MacbethWB.png".format(scene_name)), macbeth_wb)
+
+        if low_memory:
+            tracker.stop()
+            with open(result_path.joinpath(memory_file_name), "a") as f3:
+                f3.write(tracker.report(scene_name))
@@ -15,6 +15,7 @@ from myutils.imageutils import MAX_16BIT, my_read_image, my_write_image, rgb_to_
 import myutils.polarutils as plutil
 import myutils.weighturils as weutil
 import myutils.wbutils as wbutil
+from myutils.lowmemutils import polarAWB_lowmem, PeakMemoryTracker
 
 
 if __name__ == "__main__":
@@ -26,6 +27,11 @@ if __name__ == "__main__":
     result_path.mkdir(parents=True, exist_ok=True)
     shutil.copy("parameters.json", result_path)
 
+    # Peak memory is reported only in the low-memory mode.
+    low_memory = params.get("low_memory", False)
+    if low_memory:
+        open(result_path.joinpath("memory.txt"), "w").close()
+
     imean_paths = input_path.glob("*_imean.png")
 
     for imean_path in imean_paths:
@@ -34,44 +40,58 @@ if __name__ == "__main__":
         i090_path = Path(str(imean_path).replace("imean", "i090"))
         i135_path = Path(str(imean_path).replace("imean", "i135"))
 
-        imean = my_read_image(imean_path) / MAX_16BIT
-        i000 = my_read_image(i000_path) / MAX_16BIT
-        i045 = my_read_image(i045_path) / MAX_16BIT
-        i090 = my_read_image(i090_path) / MAX_16BIT
-        i135 = my_read_image(i135_path) / MAX_16BIT
-
-        s0, s1, s2 = plutil.calc_s0s1s2_from_fourPolar(i000, i045, i090, i135)
-        dolp = plutil.calc_dolp_from_s0s1s2(s0, s1, s2)
-        aolp = plutil.calc_aolp_from_s1s2(s1, s2)
-
-        # Weights
-        w_valid = weutil.valid_weight_fourPolar(i000, i045, i090, i135, th=params["valid_th"])
-        w_dolp = weutil.sigmoid(
-            np.mean(dolp, axis=2), alpha=params["w_dolp_a"], center=params["w_dolp_b"])
-        w_dolp_ach = weutil.rg_bg_sigmoid_weight_achromatic(
-            dolp, alpha=params["w_dolp_ach_a"], center=params["w_dolp_ach_b"], normalize=True)
-        w_aolp_ach = weutil.rg_bg_sigmoid_weight_achromatic_phase(
-            aolp, alpha=params["w_aolp_ach_a"], center=params["w_aolp_ach_b"])
-
-        w_dolp_ch = weutil.rg_bg_sigmoid_weight_chromatic(
-            dolp, alpha=params["w_dolp_ch_a"], center=params["w_dolp_ch_b"], normalize=True)
-        w_aolp_ch = weutil.rg_bg_sigmoid_weight_achromatic_phase(
-            aolp, alpha=params["w_aolp_ch_a"], center=params["w_aolp_ch_b"])
-
-        weight_achromatic = w_valid * w_dolp * w_dolp_ach * w_aolp_ach
-        weight_chromatic = w_valid * w_dolp * w_dolp_ch * w_aolp_ch
-
-        # WB.
-        illum_est = wbutil.polarAWB(dolp, imean, weight_achromatic, weight_chromatic, params["alpha"])
+        if low_memory:
+            tracker = PeakMemoryTracker()
+            tracker.start()
+
+            illum_est, imean = polarAWB_lowmem(
+                imean_path, i000_path, i045_path, i090_path, i135_path, params)
+        else:
+            imean = my_read_image(imean_path) / MAX_16BIT
+            i000 = my_read_image(i000_path) / MAX_16BIT
+            i045 = my_read_image(i045_path) / MAX_16BIT
+            i090 = my_read_image(i090_path) / MAX_16BIT
+            i135 = my_read_image(i135_path) / MAX_16BIT
+
+            s0, s1, s2 = plutil.calc_s0s1s2_from_fourPolar(i000, i045, i090, i135)
+            dolp = plutil.calc_dolp_from_s0s1s2(s0, s1, s2)
+            aolp = plutil.calc_aolp_from_s1s2(s1, s2)
+
+            # Weights
+            w_valid = weutil.valid_weight_fourPolar(i000, i045, i090, i135, th=params["valid_th"])
+            w_dolp = weutil.sigmoid(
+                np.mean(dolp, axis=2), alpha=params["w_dolp_a"], center=params["w_dolp_b"])
+            w_dolp_ach = weutil.rg_bg_sigmoid_weight_achromatic(
+                dolp, alpha=params["w_dolp_ach_a"], center=params["w_dolp_ach_b"], normalize=True)
+            w_aolp_ach = weutil.rg_bg_sigmoid_weight_achromatic_phase(
+                aolp, alpha=params["w_aolp_ach_a"], center=params["w_aolp_ach_b"])
+
+            w_dolp_ch = weutil.rg_bg_sigmoid_weight_chromatic(
+                dolp, alpha=params["w_dolp_ch_a"], center=params["w_dolp_ch_b"], normalize=True)
+            w_aolp_ch = weutil.rg_bg_sigmoid_weight_achromatic_phase(
+                aolp, alpha=params["w_aolp_ch_a"], center=params["w_aolp_ch_b"])
+
+            weight_achromatic = w_valid * w_dolp * w_dolp_ach * w_aolp_ach
+            weight_chromatic = w_valid * w_dolp * w_dolp_ch * w_aolp_ch
+
+            # WB.
+            illum_est = wbutil.polarAWB(dolp, imean, weight_achromatic, weight_chromatic, params["alpha"])
 
         # Save White-balanced Images.
         imean[..., 0] /= illum_est[..., 0]
         imean[..., 2] /= illum_est[..., 2]
-        imean = np.clip(imean, 0, 1)
+        np.clip(imean, 0, 1, out=imean)
 
         imean_sRGB = rgb_to_srgb(imean)
-        imean_sRGB = np.clip(imean_sRGB, 0, 1)
+        np.clip(imean_sRGB, 0, 1, out=imean_sRGB)
+        imean_sRGB *= MAX_16BIT
+        imean *= MAX_16BIT
 
         scene_name = str(imean_path.name).replace("_imean", "")
-        my_write_image(result_path.joinpath("{}.png".format(scene_name)), imean * MAX_16BIT)
-        my_write_image(result_path.joinpath("{}_sRGB.png".format(scene_name)), imean_sRGB * MAX_16BIT)
+        my_write_image(result_path.joinpath("{}.png".format(scene_name)), imean)
+        my_write_image(result_path.joinpath("{}_sRGB.png".format(scene_name)), imean_sRGB)
+
+        if low_memory:
+            tracker.stop()
+            with open(result_path.joinpath("memory.txt"), "a") as f:
+                f.write(tracker.report(scene_name))
@@ -6,15 +6,14 @@ http://opensource.org/licenses/mit-license.php
 """
 
 from pathlib import Path
-import numpy as np
-from myutils.datautils import scene_err_list, calc_various_metrics
+from myutils.datautils import scene_err_matrix, calc_various_metrics
 
 blueSky_names = ["scene014", "scene017", "scene024"]
 
 if __name__ == "__main__":
     result_path = Path("results/")
 
-    scene_names, errs, errNoSky = scene_err_list(result_path, blueSky_names)
+    scene_names, errs, noSky_mask = scene_err_matrix([result_path], blueSky_names)
 
-    calc_various_metrics(np.array(errs), "Ours w/ blue-sky scenes")
-    calc_various_metrics(np.array(errNoSky), "Ours w/o blue-sky scenes")
+    calc_various_metrics(errs[0], "Ours w/ blue-sky scenes")
+    calc_various_metrics(errs[0][noSky_mask], "Ours w/o blue-sky scenes")